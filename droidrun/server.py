@@ -9,6 +9,9 @@ import re
 import os
 import sys
 import io
+import json
+import time
+import contextvars
 from datetime import datetime
 from pathlib import Path
 from contextlib import redirect_stdout
@@ -19,14 +22,49 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
 
-from droidrun import DroidAgent, DroidrunConfig, AgentConfig, AdbTools
-from llama_index.llms.litellm import LiteLLM
+try:
+    import orjson  # optional: faster encoding for websocket broadcasts
+except ImportError:
+    orjson = None
+
+# droidrun and llama_index are heavy; they are imported on first agent use so
+# the web UI, /status and /check-device come up without waiting for them
 
 # Store for active tasks and agent outputs
 tasks = {}
 connected_clients = {}
 agent_outputs = {}
 
+# Finished tasks stay readable via /status for this long, then are dropped
+_TASK_TTL = 3600
+
+# One phone: only one agent drives the device at a time
+_device_lock = asyncio.Lock()
+
+# Last `adb devices` result; concurrent callers within the TTL share one probe
+_DEV_CACHE = {"ts": 0.0, "ok": False}
+_DEV_CACHE_TTL = 1.5
+_dev_probe_lock = asyncio.Lock()
+
+# Recent successful searches keyed by (app, normalised product): (timestamp, result)
+_RESULT_CACHE = {}
+_RESULT_CACHE_TTL = 300
+_RESULT_CACHE_MAX = 2048
+
+# Price/product patterns, compiled once for the per-output extraction
+# Alternatives are tried left to right at each position, so one pass finds
+# "PRICE: ₹X" tags, "price is ₹X" phrases and bare ₹X amounts together
+_PRICE_RE = re.compile(
+    r'PRICE:\s*₹?\s*(?P<tag>[\d,]+(?:\.\d{1,2})?)'
+    r'|price\s+is\s+₹?\s*(?P<is>[\d,]+)'
+    r'|₹\s*(?P<sym>[\d,]+)',
+    re.IGNORECASE
+)
+_PROD_RE = re.compile(r'for\s+([^"\n]+?)(?:\"|$|\n|\))', re.IGNORECASE)
+
+# The final complete() call lands at the end of the output, so look there first
+_TAIL_CHARS = 8192
+
 app = FastAPI(title="Price Comparison API")
 
 app.add_middleware(
@@ -47,92 +85,183 @@ class OrderRequest(BaseModel):
     product: str
     app: str
 
+_llm = None
+
 def get_llm():
-    return LiteLLM(
-        model="openrouter/google/gemini-2.0-flash-001",
-        api_key=os.environ.get("OPENROUTER_API_KEY")
-    )
+    # Shared across searches so the client and its HTTP connections are reused
+    global _llm
+    if _llm is None:
+        from llama_index.llms.litellm import LiteLLM
+        _llm = LiteLLM(
+            model="openrouter/google/gemini-2.0-flash-001",
+            api_key=os.environ.get("OPENROUTER_API_KEY")
+        )
+    return _llm
+
+# Search goals are laid out most-shared first: this preamble (identical for
+# every app), then the app's static steps, then the product. The product is
+# kept out of the static parts so the prompt prefix is byte-identical across
+# searches and providers can reuse their prompt cache.
+SEARCH_PREAMBLE = """You are a price-hunter agent comparing prices on Flipkart, Amazon, Blinkit and Zepto.
+
+Rules (all apps):
+- Search exactly the TARGET PRODUCT given at the end.
+- Read the price of the FIRST matching result only.
+- After the app's steps below, report it with: complete(success=True, reason="PRICE: ₹XXX for [product]")
+- If stuck, use system_button('Back')
+
+"""
 
-def get_search_prompt(app_name: str, product: str) -> str:
-    prompts = {
-        "flipkart": f"""Find price of '{product}' on Flipkart.
+STATIC_PROMPTS = {
+    "flipkart": """Find the price of the TARGET PRODUCT (given at the end) on Flipkart.
 
 1. open_app('Flipkart')
 2. Wait 2 sec
 3. Tap search bar
-4. Type '{product}'
+4. Type the TARGET PRODUCT
 5. Tap search/Enter
-6. LOOK at first result - find price (₹XXX)
-7. Call: complete(success=True, reason="PRICE: ₹XXX for [product]")
-
-If stuck, use system_button('Back')
+6. Find the price (₹XXX)
 """,
-        "amazon": f"""Find price of '{product}' on Amazon.
+    "amazon": """Find the price of the TARGET PRODUCT (given at the end) on Amazon.
 
-1. open_app('Amazon Shopping')  
+1. open_app('Amazon Shopping')
 2. Wait 2 sec
 3. Tap search bar
-4. Type '{product}'
+4. Type the TARGET PRODUCT
 5. Tap search
-6. Look at FIRST result price
-7. Call: complete(success=True, reason="PRICE: ₹XXX for [product]")
+6. Find the price (₹XXX)
 """,
-        "blinkit": f"""Find price of '{product}' on Blinkit.
+    "blinkit": """Find the price of the TARGET PRODUCT (given at the end) on Blinkit.
 
 1. open_app('Blinkit')
 2. Tap search
-3. Type '{product}'
-4. Look at first product price
-5. Call: complete(success=True, reason="PRICE: ₹XXX for [product]")
+3. Type the TARGET PRODUCT
+4. Find the price (₹XXX)
 """,
-        "zepto": f"""Find price of '{product}' on Zepto.
+    "zepto": """Find the price of the TARGET PRODUCT (given at the end) on Zepto.
 
 1. open_app('Zepto')
 2. Tap search
-3. Type '{product}'  
-4. Look at first product price
-5. Call: complete(success=True, reason="PRICE: ₹XXX for [product]")
+3. Type the TARGET PRODUCT
+4. Find the price (₹XXX)
 """
-    }
-    return prompts.get(app_name, "")
+}
+
+def get_search_prompt(app_name: str, product: str) -> tuple:
+    """Return (static_prefix, dynamic_suffix) for an app search"""
+    app_steps = STATIC_PROMPTS.get(app_name, "")
+    if not app_steps:
+        return "", ""
+    return SEARCH_PREAMBLE + app_steps, f"\nTARGET PRODUCT: '{product}'\n"
+
+# OutputCapture active in the current task (and tasks it spawns), if any
+_active_capture = contextvars.ContextVar("_active_capture", default=None)
+
+class _StdoutRouter:
+    """sys.stdout stand-in that tees writes into the calling task's OutputCapture"""
+    def __init__(self, stream):
+        self.stream = stream
+        
+    def write(self, text):
+        capture = _active_capture.get()
+        if capture is not None:
+            capture.write(text)
+        return self.stream.write(text)
+        
+    def flush(self):
+        self.stream.flush()
+        
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
 class OutputCapture:
     """Capture print output during agent run"""
     def __init__(self):
-        self.output = []
-        self.original_stdout = sys.stdout
+        self._buf = io.StringIO()
         
     def write(self, text):
-        self.output.append(text)
-        self.original_stdout.write(text)
-        
-    def flush(self):
-        self.original_stdout.flush()
+        self._buf.write(text)
         
     def get_output(self):
-        return ''.join(self.output)
+        return self._buf.getvalue()
+    
+    def __enter__(self):
+        # Searches run concurrently, so stdout is routed per task rather than
+        # swapped: prints from other tasks never reach this buffer
+        if not isinstance(sys.stdout, _StdoutRouter):
+            sys.stdout = _StdoutRouter(sys.stdout)
+        self._token = _active_capture.set(self)
+        return self
+    
+    def __exit__(self, *exc):
+        _active_capture.reset(self._token)
+        return False
 
 async def check_device() -> bool:
+    if time.monotonic() - _DEV_CACHE["ts"] < _DEV_CACHE_TTL:
+        return _DEV_CACHE["ok"]
+    async with _dev_probe_lock:
+        if time.monotonic() - _DEV_CACHE["ts"] < _DEV_CACHE_TTL:
+            return _DEV_CACHE["ok"]
+        ok = await _probe_device()
+        _DEV_CACHE["ts"] = time.monotonic()
+        _DEV_CACHE["ok"] = ok
+        return ok
+
+def invalidate_device_cache():
+    _DEV_CACHE["ts"] = 0.0
+
+async def _probe_device() -> bool:
     try:
         proc = await asyncio.create_subprocess_exec(
             'adb', 'devices',
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.DEVNULL
         )
-        stdout, _ = await proc.communicate()
-        output = stdout.decode()
-        for line in output.split('\n'):
-            if 'device' in line and 'List' not in line and 'unauthorized' not in line:
-                return True
-        return False
+        try:
+            # Ready devices are listed as "<serial>\tdevice"; unauthorized/offline ones
+            # never match. Stop reading at the first ready one.
+            async for line in proc.stdout:
+                if line.rstrip().endswith(b'\tdevice'):
+                    return True
+            return False
+        finally:
+            if proc.returncode is None:
+                try:
+                    proc.terminate()
+                except ProcessLookupError:
+                    pass
+            await proc.wait()
     except:
         return False
 
+def _get_cached_result(key: tuple) -> Optional[dict]:
+    entry = _RESULT_CACHE.get(key)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[0] >= _RESULT_CACHE_TTL:
+        _RESULT_CACHE.pop(key, None)
+        return None
+    return dict(entry[1])
+
+def _store_result(key: tuple, result: dict):
+    _RESULT_CACHE.pop(key, None)
+    if len(_RESULT_CACHE) >= _RESULT_CACHE_MAX:
+        # Oldest entry first in insertion order
+        del _RESULT_CACHE[next(iter(_RESULT_CACHE))]
+    _RESULT_CACHE[key] = (time.monotonic(), dict(result))
+
 async def search_app(app_name: str, product: str, task_id: str) -> dict:
     print(f"\n{'='*50}")
     print(f"🔍 Searching {app_name.upper()} for '{product}'")
     print(f"{'='*50}")
     
+    cache_key = (app_name, product.strip().lower())
+    cached = _get_cached_result(cache_key)
+    if cached:
+        print(f"♻️ Using cached {app_name} result")
+        return cached
+    
     if not await check_device():
         return {
             "app": app_name,
@@ -142,28 +271,32 @@ async def search_app(app_name: str, product: str, task_id: str) -> dict:
             "error": "Phone not connected"
         }
     
-    prompt = get_search_prompt(app_name, product)
-    capture = OutputCapture()
+    # Static prefix first, product last, so the goal shares a cacheable prefix
+    static_prefix, dynamic_suffix = get_search_prompt(app_name, product)
+    prompt = static_prefix + dynamic_suffix
     
     try:
-        llm = get_llm()
-        tools = AdbTools()
-        
-        agent = DroidAgent(
-            prompt,
-            config=DroidrunConfig(agent=AgentConfig(max_steps=18)),
-            llms=llm,
-            tools=tools
-        )
-        
-        # Capture output during run
-        old_stdout = sys.stdout
-        sys.stdout = capture
-        
-        try:
-            result = await agent.run()
-        finally:
-            sys.stdout = old_stdout
+        # Wait for the phone, then build the agent so it sees current device
+        # state, and capture output during run
+        async with _device_lock:
+            from droidrun import DroidAgent, DroidrunConfig, AgentConfig, AdbTools
+            llm = get_llm()
+            tools = AdbTools()
+            
+            agent = DroidAgent(
+                prompt,
+                config=DroidrunConfig(agent=AgentConfig(max_steps=18)),
+                llms=llm,
+                tools=tools
+            )
+            
+            await broadcast_update(task_id, {
+                "status": "searching",
+                "current_app": app_name,
+                "message": f"Searching {app_name.capitalize()}..."
+            })
+            with OutputCapture() as capture:
+                result = await agent.run()
         
         # Get captured output
         output = capture.get_output()
@@ -174,17 +307,21 @@ async def search_app(app_name: str, product: str, task_id: str) -> dict:
         print(f"📋 Captured {len(output)} chars of output")
         
         # Extract price from captured output
-        price = extract_price_from_output(full_output)
+        price, price_kind = _find_price(full_output)
         product_name = extract_product_from_output(full_output, product)
         
         if price:
             print(f"✅ Found price: ₹{price}")
-            return {
+            result = {
                 "app": app_name,
                 "product": product_name,
                 "found": True,
                 "price": price
             }
+            # Only trust the agent's own complete() report enough to reuse it
+            if price_kind == 'tag':
+                _store_result(cache_key, result)
+            return result
         else:
             print(f"⚠️ No price found")
             return {
@@ -196,7 +333,8 @@ async def search_app(app_name: str, product: str, task_id: str) -> dict:
             }
             
     except Exception as e:
-        sys.stdout = old_stdout if 'old_stdout' in dir() else sys.stdout
+        # Errors are often the phone dropping off; re-probe on the next check
+        invalidate_device_cache()
         print(f"❌ Error: {str(e)[:100]}")
         return {
             "app": app_name,
@@ -208,47 +346,86 @@ async def search_app(app_name: str, product: str, task_id: str) -> dict:
 
 def extract_price_from_output(text: str) -> Optional[str]:
     """Extract price from agent output looking for PRICE: pattern"""
+    return _find_price(text)[0]
+
+def _find_price(text: str) -> tuple:
+    """Return (price, kind) where kind is the _PRICE_RE group that matched, or (None, None)"""
     if not text:
-        return None
+        return None, None
     
-    # Pattern 1: PRICE: ₹XXX pattern from complete() calls
-    match = re.search(r'PRICE:\s*₹?\s*([\d,]+(?:\.\d{1,2})?)', text, re.IGNORECASE)
-    if match:
-        return match.group(1).replace(',', '')
-    
-    # Pattern 2: "The price is ₹XXX"
-    match = re.search(r'price\s+is\s+₹?\s*([\d,]+)', text, re.IGNORECASE)
-    if match:
-        return match.group(1).replace(',', '')
+    # Fast path: the complete() PRICE: tag is near the end of the output
+    if len(text) > _TAIL_CHARS:
+        for match in _PRICE_RE.finditer(text, len(text) - _TAIL_CHARS):
+            if match.lastgroup == 'tag':
+                return match.group('tag').replace(',', ''), 'tag'
     
-    # Pattern 3: ₹XXX in the text
-    matches = re.findall(r'₹\s*([\d,]+)', text)
-    for m in matches:
-        try:
-            val = float(m.replace(',', ''))
-            if 10 <= val <= 50000:
-                return m.replace(',', '')
-        except:
-            pass
+    # Priority: PRICE: tag from complete() > "The price is ₹XXX" > any ₹XXX
+    price_is = None
+    symbol_price = None
+    for match in _PRICE_RE.finditer(text):
+        kind = match.lastgroup
+        if kind == 'tag':
+            return match.group('tag').replace(',', ''), 'tag'
+        if kind == 'is':
+            if price_is is None:
+                price_is = match.group('is').replace(',', '')
+        elif symbol_price is None and price_is is None:
+            # [\d,]+ leaves only digits once commas go; a lone "," strips to ""
+            digits = match.group('sym').replace(',', '')
+            if digits.isdigit() and 10 <= int(digits) <= 50000:
+                symbol_price = digits
     
-    return None
+    if price_is is not None:
+        return price_is, 'is'
+    if symbol_price is not None:
+        return symbol_price, 'sym'
+    return None, None
 
 def extract_product_from_output(text: str, default: str) -> str:
     """Extract product name from output"""
-    match = re.search(r'for\s+([^"\n]+?)(?:\"|$|\n|\))', text, re.IGNORECASE)
+    if len(text) > _TAIL_CHARS:
+        match = _PROD_RE.search(text, len(text) - _TAIL_CHARS)
+        if match:
+            name = match.group(1).strip()
+            if 3 < len(name) < 100:
+                return name
+    
+    match = _PROD_RE.search(text)
     if match:
         name = match.group(1).strip()
         if 3 < len(name) < 100:
             return name
     return default
 
+def _dumps(message: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(message)
+    return json.dumps(message, separators=(',', ':'), ensure_ascii=False).encode()
+
 async def broadcast_update(task_id: str, message: dict):
-    if task_id in connected_clients:
-        for ws in connected_clients[task_id]:
-            try:
-                await ws.send_json(message)
-            except:
-                pass
+    queues = connected_clients.get(task_id)
+    if not queues:
+        return
+    # Serialise once for all clients, then hand off to each client's writer;
+    # a full queue means a stuck client, so drop
+    data = _dumps(message)
+    for queue in queues:
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            pass
+
+async def _ws_writer(websocket: WebSocket, queue: asyncio.Queue):
+    """Send queued updates to one client so a slow socket only delays itself"""
+    while True:
+        # Everything queued since the last send goes out as one JSON array frame
+        batch = [await queue.get()]
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        try:
+            await websocket.send_bytes(b'[' + b','.join(batch) + b']')
+        except:
+            return
 
 @app.get("/")
 async def root():
@@ -262,19 +439,18 @@ async def search_product(request: SearchRequest):
     print(f"\n🚀 Search: '{request.product}'")
     
     if request.app:
-        asyncio.create_task(run_single_search(task_id, request.product, request.app))
+        job = asyncio.create_task(run_single_search(task_id, request.product, request.app))
     else:
-        asyncio.create_task(run_search(task_id, request.product))
+        job = asyncio.create_task(run_search(task_id, request.product))
+    job.add_done_callback(lambda _: _expire_task(task_id))
     
     return {"task_id": task_id, "status": "started"}
 
+def _expire_task(task_id: str):
+    asyncio.get_running_loop().call_later(_TASK_TTL, tasks.pop, task_id, None)
+
 async def run_single_search(task_id: str, product: str, app: str):
     tasks[task_id]["status"] = "searching"
-    await broadcast_update(task_id, {
-        "status": "searching",
-        "current_app": app,
-        "message": f"Searching {app.capitalize()}..."
-    })
     
     result = await search_app(app, product, task_id)
     tasks[task_id]["results"][app] = result
@@ -293,28 +469,22 @@ async def run_search(task_id: str, product: str):
     tasks[task_id]["status"] = "searching"
     await broadcast_update(task_id, {"status": "searching", "message": "Starting..."})
     
-    for app in apps:
-        if not await check_device():
-            tasks[task_id]["results"][app] = {"app": app, "found": False, "error": "Phone disconnected"}
-            await broadcast_update(task_id, {"status": "searching", "app_complete": app, "result": tasks[task_id]["results"][app]})
-            continue
-        
-        await broadcast_update(task_id, {
-            "status": "searching",
-            "current_app": app,
-            "message": f"Searching {app.capitalize()}..."
-        })
-        
+    async def search_one(app: str) -> dict:
+        # search_app does its own device check
         result = await search_app(app, product, task_id)
         tasks[task_id]["results"][app] = result
-        
         await broadcast_update(task_id, {
             "status": "searching",
             "app_complete": app,
             "result": result
         })
-        
-        await asyncio.sleep(2)
+        return result
+    
+    # Apps share the phone via _device_lock; everything around the agent runs overlaps
+    outcomes = await asyncio.gather(*(search_one(app) for app in apps), return_exceptions=True)
+    for app, outcome in zip(apps, outcomes):
+        if isinstance(outcome, Exception):
+            tasks[task_id]["results"][app] = {"app": app, "found": False, "error": str(outcome)[:50]}
     
     # Best price
     best = None
@@ -348,6 +518,12 @@ async def get_status(task_id: str):
 async def api_check_device():
     return {"connected": await check_device()}
 
+@app.post("/cache/invalidate")
+async def invalidate_cache():
+    cleared = len(_RESULT_CACHE)
+    _RESULT_CACHE.clear()
+    return {"cleared": cleared}
+
 @app.post("/order")
 async def place_order(request: OrderRequest):
     task_id = str(uuid.uuid4())
@@ -367,14 +543,16 @@ async def place_order(request: OrderRequest):
 
 async def run_order(task_id: str, app: str, prompt: str):
     try:
-        llm = get_llm()
-        agent = DroidAgent(
-            prompt,
-            config=DroidrunConfig(agent=AgentConfig(max_steps=40)),
-            llms=llm,
-            tools=AdbTools()
-        )
-        result = await agent.run()
+        async with _device_lock:
+            from droidrun import DroidAgent, DroidrunConfig, AgentConfig, AdbTools
+            llm = get_llm()
+            agent = DroidAgent(
+                prompt,
+                config=DroidrunConfig(agent=AgentConfig(max_steps=40)),
+                llms=llm,
+                tools=AdbTools()
+            )
+            result = await agent.run()
         await broadcast_update(task_id, {"status": "completed", "app": app, "result": str(result)})
     except Exception as e:
         await broadcast_update(task_id, {"status": "error", "app": app, "error": str(e)})
@@ -382,23 +560,49 @@ async def run_order(task_id: str, app: str, prompt: str):
 @app.websocket("/ws/{task_id}")
 async def websocket_endpoint(websocket: WebSocket, task_id: str):
     await websocket.accept()
+    queue = asyncio.Queue(maxsize=32)
+    writer = asyncio.create_task(_ws_writer(websocket, queue))
     if task_id not in connected_clients:
         connected_clients[task_id] = []
-    connected_clients[task_id].append(websocket)
+    connected_clients[task_id].append(queue)
+    
+    # Replay progress made before this client subscribed; cached searches
+    # can finish before the browser opens its socket
+    task = tasks.get(task_id)
+    if task is not None:
+        for app_name, result in task["results"].items():
+            queue.put_nowait(_dumps({"status": "searching", "app_complete": app_name, "result": result}))
+        if task["status"] == "completed":
+            queue.put_nowait(_dumps({
+                "status": "completed",
+                "results": task["results"],
+                "best": task.get("best")
+            }))
     
     try:
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
+        pass
+    finally:
+        writer.cancel()
         if task_id in connected_clients:
-            connected_clients[task_id].remove(websocket)
+            connected_clients[task_id].remove(queue)
+            if not connected_clients[task_id]:
+                del connected_clients[task_id]
 
 if __name__ == "__main__":
     import uvicorn
+    from importlib.util import find_spec
+    # uvicorn picks uvloop (not on Windows) and httptools by itself when they are
+    # installed, e.g. via `pip install uvicorn[standard]`; this only reports it
+    loop = "uvloop" if sys.platform != "win32" and find_spec("uvloop") else "asyncio"
+    http = "httptools" if find_spec("httptools") else "h11"
     print("=" * 60)
     print("🎯 PriceHunter Server v4 - Output Capture Edition")
     print("=" * 60)
     print("📱 Connect phone via USB (USB debugging ON)")
     print("🌐 http://localhost:8000")
+    print(f"⚙️ Event loop: {loop}, HTTP parser: {http}")
     print("=" * 60)
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -6,6 +6,7 @@ class PriceHunter {
         this.currentProduct = null;
         this.ws = null;
         this.results = {};
+        this.decoder = new TextDecoder();
 
         this.initElements();
         this.bindEvents();
@@ -115,14 +116,14 @@ class PriceHunter {
     connectWebSocket(taskId) {
         const wsUrl = `ws://${window.location.host}/ws/${taskId}`;
         this.ws = new WebSocket(wsUrl);
+        this.ws.binaryType = 'arraybuffer';
 
         this.ws.onopen = () => {
             console.log('WebSocket connected');
         };
 
         this.ws.onmessage = (event) => {
-            const data = JSON.parse(event.data);
-            this.handleUpdate(data);
+            this.parseMessage(event).forEach(data => this.handleUpdate(data));
         };
 
         this.ws.onerror = (error) => {
@@ -134,6 +135,13 @@ class PriceHunter {
         };
     }
 
+    parseMessage(event) {
+        // Updates arrive as UTF-8 JSON arrays (one frame may batch several) in binary frames
+        const text = typeof event.data === 'string' ? event.data : this.decoder.decode(event.data);
+        const data = JSON.parse(text);
+        return Array.isArray(data) ? data : [data];
+    }
+
     handleUpdate(data) {
         console.log('Update:', data);
 
@@ -285,9 +293,12 @@ class PriceHunter {
 
             // Connect to WebSocket for order updates
             const orderWs = new WebSocket(`ws://${window.location.host}/ws/${data.task_id}`);
+            orderWs.binaryType = 'arraybuffer';
 
             orderWs.onmessage = (event) => {
-                const update = JSON.parse(event.data);
+                // Only the final status in a batch matters here
+                const updates = this.parseMessage(event);
+                const update = updates[updates.length - 1];
 
                 if (update.status === 'completed') {
                     this.orderStatusTitle.textContent = '✅ Order Placed!';